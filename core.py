@@ -9,7 +9,6 @@ import os
 import json
 import pathspec
 from typing import List, Dict, Any, Optional, Union, Tuple
-from sentence_transformers import SentenceTransformer
 
 from models import AppState, ProjConfig, ProjState, FileState, ChatSession, ProjectStructure
 from config import (
@@ -24,13 +23,10 @@ from utils import (
     get_proj_stat, print_proj_stat, load_proj_state, save_proj_state,
     get_tokens_cnt, limit_string, remove_comments, trim_code, get_cost,
     bytes_to_str, add_path_prefix, remove_path_prefix, load_file_content,
-    find_files_semantic, find_in_files, edit_list
+    find_files_semantic, find_in_files, edit_list, get_embed_model, get_embedding_cache
 )
 from analyzers import ProjectAnalyzer, CodeAnalyzer
 
-# Словарь для кэширования эмбеддингов файлов
-_embeddings_cache = {}
-
 # Константы
 LARGE_SOURCE_FILE_WARNING = 100000  # 100 KB
 LARGE_PROJECT_FILES_WARNING = 500  # Файлов
@@ -550,19 +546,16 @@ def generate_embedding(app_state: AppState, content: str) -> List[float]:
     content2 = limit_string (content, 8000)
     print ('Создание эмбеддинга...')
 
-    # Используем кэш, если возможно
-    content_hash = hash (content2)
-    if content_hash in _embeddings_cache:
-        print ('Эмбеддинг найден в кэше')
-        return _embeddings_cache[content_hash]
+    model_path = app_state.app_config.embedding_model_path
 
-    try:
-        model = SentenceTransformer (app_state.app_config.embedding_model_path)
-        embeddings = model.encode ([content2], convert_to_tensor=False)
-        embedding = embeddings[0].tolist ()
+    def encode_content():
+        # Модель загружается один раз на процесс и переиспользуется для всех файлов
+        model = get_embed_model (model_path)
+        return model.encode ([content2], convert_to_tensor=False)[0]
 
-        # Сохраняем в кэш
-        _embeddings_cache[content_hash] = embedding
+    try:
+        # Дисковый кэш переживает перезапуски: неизмененные файлы повторно не кодируются
+        embedding = get_embedding_cache ().get_or_compute (model_path, content2, encode_content).tolist ()
 
         print ('Эмбеддинг создан')
         return embedding
@@ -5,7 +5,7 @@
 """
 
 from typing import List, Dict, Optional, Any, Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from openai import OpenAI
 
 from config import AppConfig, ProjConfig
@@ -89,6 +89,10 @@ class ProjState (BaseModel):
     files: List[FileState] = []
     structure: Optional[ProjectStructure] = None
 
+    # Кэш нормализованной матрицы эмбеддингов для семантического поиска (не сериализуется)
+    _embed_matrix: Any = PrivateAttr (default=None)
+    _embed_files: List[FileState] = PrivateAttr (default_factory=list)
+
 
 class AppState:
     """
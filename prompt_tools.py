@@ -8,79 +8,123 @@
 import os
 import re
 import json
-import numpy as np
+import shutil
+import codecs
+import logging
+import tempfile
 from typing import List, Dict, Any, Optional
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
 
 from models import AppState, FileState
 from utils import (
-    input_yes_no, is_no, load_file_content, add_path_prefix,
+    input_yes_no, is_no, load_file_content, find_in_files,
+    find_files_semantic, invalidate_embed_matrix, add_path_prefix,
     remove_path_prefix, trim_code, remove_comments
 )
 import re
 
+# Отладочный вывод пишется в общий логгер приложения и по умолчанию отключен
+log = logging.getLogger ('PromptFusion.prompt_tools')
 
-def fix_encoding(broken_text):
-    """
-    Исправляет битую кодировку кириллицы, работая с байтами напрямую.
+# Шаблоны для распознавания вызовов функций в тексте компилируются один раз
+_FUNCTION_RE = re.compile (r'\[FUNCTION: (\w+)\((.*?)\)\]')
+# Аргументы: строки в одиночных и двойных кавычках, а также числовые и булевы значения
+_ARGS_RE = re.compile (r'(\w+)=(?:\"((?:\\.|[^\"])*)\"|\'((?:\\.|[^\'])*?)\'|(\d+\.\d+)|(\d+)|(true|false))')
 
-    Args:
-        broken_text: Строка с битой кодировкой
+
+def _build_mojibake_pairs():
+    """
+    Строит таблицу замен для двухбайтовых последовательностей c2xx/c3xx,
+    в которые превращается UTF-8 кириллица, прочитанная как Latin1.
 
     Returns:
-        Исправленная строка
+        Словарь: исходная пара байтов -> восстановленные байты
     """
-    # Получаем байты через UTF-8 с заменой
-    raw_bytes = broken_text.encode('utf-8', errors='replace')
-    print(f"Исходные байты: {raw_bytes.hex()}")
-
-    # Проверяем стандартный путь: Latin1 -> UTF-8
-    try:
-        temp_bytes = broken_text.encode('latin1', errors='replace')
-        result = temp_bytes.decode('utf-8', errors='ignore')
-        if any(1040 <= ord(c) <= 1103 for c in result):
-            print("Успешное преобразование: latin1-encoded UTF-8 -> UTF-8")
-            return result
-    except UnicodeError as e:
-        print(f"Ошибка при декодировании Latin1 -> UTF-8: {str(e)}")
-
-    # Упрощённый подход: собираем только валидные UTF-8 последовательности
-    corrected_bytes = bytearray()
-    i = 0
-    while i < len(raw_bytes):
-        # Пропускаем символ замены (efbfbd)
-        if i + 2 < len(raw_bytes) and raw_bytes[i:i+3] == b'\xef\xbf\xbd':
-            i += 3
-            continue
-        # Обрабатываем c3xx или c2xx как Latin1-интерпретированный UTF-8
-        if i + 1 < len(raw_bytes) and raw_bytes[i] in (0xc3, 0xc2):
-            byte2 = raw_bytes[i + 1]
+    pairs = {b'\xef\xbf\xbd': b''}  # Символ замены просто отбрасываем
+    for lead in (0xc2, 0xc3):
+        for byte2 in range(256):
             if 0xa0 <= byte2 <= 0xbf:  # Кириллица в UTF-8 начинается с d0 или d1
-                corrected_bytes.extend(bytes([0xd0 + ((byte2 - 0xa0) // 4), 0x80 + (byte2 & 0x3f)]))
+                fixed = bytes([0xd0 + ((byte2 - 0xa0) // 4), 0x80 + (byte2 & 0x3f)])
             elif 0x80 <= byte2 <= 0x9f:  # Дополнительные символы
-                corrected_bytes.extend(bytes([0xd0, byte2]))
+                fixed = bytes([0xd0, byte2])
             else:
-                corrected_bytes.append(raw_bytes[i])
-            i += 2
-        else:
-            corrected_bytes.append(raw_bytes[i])
-            i += 1
+                fixed = bytes([lead])
+            pairs[bytes([lead, byte2])] = fixed
+    return pairs
 
-    print(f"Скорректированные байты: {corrected_bytes.hex()}")
 
-    # Декодируем результат
-    try:
-        result = corrected_bytes.decode('utf-8', errors='ignore')
-        if any(1040 <= ord(c) <= 1103 for c in result):
-            print("Успешное восстановление через анализ байтов")
-            return result
-        else:
-            print("Результат не содержит кириллицу")
-    except UnicodeError as e:
-        print(f"Ошибка при декодировании скорректированных байтов: {str(e)}")
+# Таблица и шаблон строятся один раз при загрузке модуля,
+# чтобы восстановление байтов выполнялось одним вызовом re.sub
+_MOJIBAKE_PAIRS = _build_mojibake_pairs ()
+_MOJIBAKE_RE = re.compile (rb'\xef\xbf\xbd|[\xc2\xc3][\x00-\xff]')
+_CYR_RE = re.compile ('[\u0410-\u044F]')
+
+# Escape-последовательности, которые модель чаще всего оставляет в аргументах
+_ESC_RE = re.compile (r'\\(?:u([0-9a-fA-F]{4})|x([0-9a-fA-F]{2})|([ntr"\'\\]))')
+_ESC_MAP = {'n': '\n', 't': '\t', 'r': '\r', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _esc_sub(match) -> str:
+    """Возвращает символ для одной найденной escape-последовательности"""
+    hex_val = match.group (1) or match.group (2)
+    if hex_val:
+        return chr (int (hex_val, 16))
+    return _ESC_MAP[match.group (3)]
+
+
+def _decode_escapes(text: str) -> str:
+    """
+    Раскрывает escape-последовательности (\\n, \\t, \\uXXXX и т.п.) в строке.
+
+    Args:
+        text: Строка с буквальными escape-последовательностями
+
+    Returns:
+        Строка с раскрытыми escape-последовательностями
+    """
+    # unicode_escape корректен только для ASCII: остальное он прочитает как Latin1
+    if text.isascii ():
+        try:
+            return codecs.decode (text, 'unicode_escape')
+        except UnicodeDecodeError as e:
+            log.debug ("Ошибка декодирования unicode_escape: %s", e)
+    return _ESC_RE.sub (_esc_sub, text)
+
+
+def fix_encoding(broken_text):
+    """
+    Исправляет битую кодировку кириллицы, работая с байтами напрямую.
+
+    Args:
+        broken_text: Строка с битой кодировкой
 
-    print("Не удалось исправить кодировку")
+    Returns:
+        Исправленная строка
+    """
+    # Стандартный путь: Latin1 -> UTF-8, обычно срабатывает сразу
+    result = broken_text.encode ('latin1', errors='replace').decode ('utf-8', errors='ignore')
+    if _CYR_RE.search (result) is not None:
+        log.debug ("fix_encoding: latin1-encoded UTF-8 -> UTF-8")
+        return result
+
+    # Текст мог быть прочитан как cp1252 вместо Latin1
+    result = broken_text.encode ('cp1252', errors='replace').decode ('utf-8', errors='ignore')
+    if _CYR_RE.search (result) is not None:
+        log.debug ("fix_encoding: cp1252-encoded UTF-8 -> UTF-8")
+        return result
+
+    # Восстанавливаем байты по заранее построенной таблице пар
+    raw_bytes = broken_text.encode ('utf-8', errors='replace')
+    corrected_bytes = _MOJIBAKE_RE.sub (lambda m: _MOJIBAKE_PAIRS[m.group ()], raw_bytes)
+    if log.isEnabledFor (logging.DEBUG):
+        log.debug ("fix_encoding: исходные байты: %s", raw_bytes.hex ())
+        log.debug ("fix_encoding: скорректированные байты: %s", corrected_bytes.hex ())
+
+    result = corrected_bytes.decode ('utf-8', errors='ignore')
+    if _CYR_RE.search (result) is not None:
+        log.debug ("fix_encoding: восстановлено через анализ байтов")
+        return result
+
+    log.debug ("fix_encoding: не удалось исправить кодировку, len=%d", len (broken_text))
     return broken_text
 
 
@@ -100,6 +144,12 @@ class PromptTools:
         self.find_page_size = 10
         self.find_max_lines = 5
 
+        # Индексы для проверки путей и поиска состояния файла за O(1);
+        # поддерживаются в актуальном состоянии в update_file_func
+        self._path_set = set (app_state.file_paths)
+        files = app_state.proj_state.files if app_state.proj_state else []
+        self._file_index = {f.path: f for f in files}
+
     def get_tools_system_prompt(self) -> str:
         """
         Возвращает дополнительные инструкции для системного промпта
@@ -166,25 +216,17 @@ class PromptTools:
         Returns:
             Optional[Dict[str, Any]]: Результат выполнения функции или None
         """
-        import re
-
-        # Шаблоны для распознавания вызовов функций в тексте
-        function_pattern = r'\[FUNCTION: (\w+)\((.*?)\)\]'
-
-        matches = re.findall (function_pattern, message)
-        if not matches:
+        # Берем только первое совпадение
+        match = _FUNCTION_RE.search (message)
+        if not match:
             return None
 
-        # Берем только первое совпадение
-        function_name, args_str = matches[0]
+        function_name, args_str = match.groups ()
 
         # Более надежный парсинг аргументов с учетом вложенных структур и экранированных кавычек
         args = {}
-        # Используем улучшенный парсер для аргументов
-        # Обрабатываем одиночные и двойные кавычки, а также числовые и булевы значения
-        args_pattern = r'(\w+)=(?:\"((?:\\.|[^\"])*)\"|\'((?:\\.|[^\'])*?)\'|(\d+\.\d+)|(\d+)|(true|false))'
-
-        for arg_match in re.findall (args_pattern, args_str):
+        # Используем улучшенный парсер для аргументов (шаблон _ARGS_RE)
+        for arg_match in _ARGS_RE.findall (args_str):
             arg_name = arg_match[0]
 
             # Находим первое непустое значение среди возможных типов
@@ -202,30 +244,8 @@ class PromptTools:
                 arg_value = float (arg_value)
 
             # Если это строка с экранированием, обрабатываем её с учетом unicode
-            if isinstance (arg_value, str) and ('\\' in arg_value or '\\u' in arg_value or '\\x' in arg_value):
-                try:
-                    # Прямой подход через codecs для разбора unicode escape-последовательностей
-                    import codecs
-                    arg_value = codecs.decode (arg_value, 'unicode_escape')
-                except Exception as e:
-                    print (f"Ошибка декодирования Unicode в аргументе: {e}")
-                    try:
-                        # Альтернативный метод - используем буфер для замены escape-последовательностей
-                        # Это безопаснее чем encode/decode
-                        import re
-
-                        # Заменяем \uXXXX последовательности на их символы
-                        def replace_unicode(match):
-                            hex_val = match.group (1)
-                            return chr (int (hex_val, 16))
-
-                        # Заменяем \n, \t и другие common escapes
-                        arg_value = arg_value.replace ('\\n', '\n').replace ('\\t', '\t').replace ('\\"', '"')
-                        # Заменяем \uXXXX последовательности
-                        arg_value = re.sub (r'\\u([0-9a-fA-F]{4})', replace_unicode, arg_value)
-                    except Exception as e2:
-                        print (f"Вторичная ошибка декодирования: {e2}")
-                        # Оставляем как есть если не получилось декодировать
+            if isinstance (arg_value, str) and '\\' in arg_value:
+                arg_value = _decode_escapes (arg_value)
 
             args[arg_name] = arg_value
 
@@ -259,7 +279,7 @@ class PromptTools:
         print (f'\nВызов функции get_file, path: {path}')
 
         clean_path = remove_path_prefix (path)
-        if clean_path not in self.app_state.file_paths:
+        if clean_path not in self._path_set:
             print (f'\n!!!!!!!!!!!!!!!!!!! неверный путь: {path}')
             return {
                 'path': path,
@@ -273,7 +293,7 @@ class PromptTools:
                 self.app_state.proj_config.path,
                 self.app_state.proj_config.remove_comments
             )
-            print (f'возвращено содержимое файла {path}')
+            log.debug ("возвращено содержимое файла %s", path)
 
             return {
                 'path': path,
@@ -302,28 +322,9 @@ class PromptTools:
         print (f"\nВызов функции find_files_semantic, query: {query}, page: {page}")
 
         try:
-            model = SentenceTransformer (self.app_state.app_config.embedding_model_path)
-            ref_embed = model.encode ([query], convert_to_tensor=False)[0]
-
-            ref_embed_array = np.array (ref_embed).reshape (1, -1)
-            sim_res = []
-
-            for file in self.app_state.proj_state.files:
-                if file.embed and len (file.embed) > 0:
-                    file_embed_array = np.array (file.embed).reshape (1, -1)
-                    similarity_score = cosine_similarity (ref_embed_array, file_embed_array)[0][0]
-                    sim_res.append ((similarity_score, file))
+            result_paths = find_files_semantic (query, self.app_state, page, self.find_page_size)
 
-            sim_res.sort (key=lambda x: x[0], reverse=True)
-            page_start = page * self.find_page_size
-            page_end = page_start + self.find_page_size
-            page_res = sim_res[page_start:page_end]
-
-            result_paths = [add_path_prefix (item[1].path) for item in page_res]
-
-            print ('результаты:')
-            for path in result_paths:
-                print (path)
+            log.debug ("результаты: %s", result_paths)
 
             return {
                 'results': result_paths,
@@ -353,48 +354,16 @@ class PromptTools:
         print (f"\nВызов функции find_in_files, query: {query}, isCaseSensitive: {is_case_sensitive}, page: {page}")
 
         try:
-            results = []
-
-            for file in self.app_state.proj_state.files:
-                try:
-                    content = load_file_content (
-                        file.path,
-                        self.app_state.proj_config.path,
-                        self.app_state.proj_config.remove_comments
-                    )
-                    lines = content.split ('\n')
-                    matched_lines = []
-
-                    for index, line in enumerate (lines):
-                        if self._line_matches (line, query, is_case_sensitive):
-                            line_number = str (index + 1).ljust (6)
-                            matched_lines.append (f"{line_number}{line}")
-
-                    if matched_lines:
-                        if len (matched_lines) > self.find_max_lines:
-                            delta = len (matched_lines) - self.find_max_lines
-                            matched_lines = matched_lines[:self.find_max_lines] + [f"и еще {delta} совпадений..."]
-
-                        results.append ({
-                            'path': add_path_prefix (file.path),
-                            'occurrences': matched_lines,
-                        })
-                except Exception as e:
-                    print (f"Ошибка при поиске в файле {file.path}: {e}")
-
-            # Возвращаем страницу результатов
-            start_idx = page * self.find_page_size
-            end_idx = start_idx + self.find_page_size
-            page_results = results[start_idx:end_idx]
-
-            print ('результаты:')
-            for file in page_results:
-                print (file['path'])
-                for occurrence in file['occurrences']:
-                    print (f"  {occurrence}")
-
-            if not page_results:
-                print ('Ничего не найдено')
+            page_results = [
+                {'path': add_path_prefix (item['path']), 'occurrences': item['occurrences']}
+                for item in find_in_files (
+                    query, is_case_sensitive, self.app_state, page,
+                    self.find_page_size, self.find_max_lines
+                )
+            ]
+
+            if log.isEnabledFor (logging.DEBUG):
+                log.debug ("результаты: %s", [file['path'] for file in page_results] or 'ничего не найдено')
 
             return {
                 'results': page_results,
@@ -410,23 +379,6 @@ class PromptTools:
                 'function': 'find_in_files'
             }
 
-    def _line_matches(self, line: str, query: str, is_case_sensitive: bool) -> bool:
-        """
-        Проверяет, содержит ли строка запрос.
-
-        Args:
-            line: Строка для проверки
-            query: Строка запроса
-            is_case_sensitive: Учитывать ли регистр
-
-        Returns:
-            bool: True, если строка содержит запрос
-        """
-        if is_case_sensitive:
-            return query in line
-        else:
-            return query.lower () in line.lower ()
-
     def update_file_func(self, path: str, content: str) -> Dict[str, Any]:
         """
         Обновляет или создает файл с корректной обработкой кодировки.
@@ -463,50 +415,57 @@ class PromptTools:
         # Обработка и декодирование многострочных строк с экранированием
 
         processed_content = content
-        print(f"Processed content: \n {processed_content} \n")
+        log.debug ("update_file: длина содержимого %d", len (processed_content))
 
         # Проверка, является ли content строкой с буквальным экранированием
         if '\\n' in content or '\\u' in content or '\\x' in content:
-            try:
-                # Используем правильное декодирование строки для обработки экранированных последовательностей
-                # Включая unicode-escape для обработки \uXXXX последовательностей
-                processed_content = content.encode ('latin1').decode ('unicode_escape')
-            except Exception as e:
-                print (f"Предупреждение при декодировании unicode: {e}")
-                try:
-                    # Альтернативный метод с использованием eval
-                    processed_content = eval (f'"""{content}"""')
-                except Exception as e2:
-                    print (f"Предупреждение при использовании eval: {e2}")
-                    # Простой метод замены
-                    processed_content = content.replace ('\\n', '\n').replace ('\\t', '\t').replace ('\\"', '"')
+            processed_content = _decode_escapes (content)
 
         # Записываем файл явно с UTF-8 кодировкой
         try:
-            # Проверка кодировки перед записью
-            print (f"Проверка кодировки перед записью: {type (processed_content)}")
-            print (f"Processed content 2 : \n {processed_content} \n")
-
-            # Явно конвертируем в UTF-8 при записи
-            with open (full_path, 'w', encoding='utf-8') as file:
-                file.write (processed_content)
+            log.debug ("update_file: записываем %d символов в %s", len (processed_content), full_path)
+
+            # Кодируем в UTF-8 один раз и пишем во временный файл, затем атомарно
+            # подменяем исходный, чтобы сбой во время записи не испортил файл
+            data = processed_content.encode ('utf-8')
+            # Уникальное скрытое имя в той же папке: существующий файл с похожим
+            # именем не будет затерт, а os.replace остается атомарным
+            fd, tmp_path = tempfile.mkstemp (dir=folder_path, prefix='.' + os.path.basename (full_path))
+            try:
+                with os.fdopen (fd, 'wb') as file:
+                    file.write (data)
+                    file.flush ()
+                    mtime = os.fstat (file.fileno ()).st_mtime
+                if os.path.exists (full_path):
+                    shutil.copymode (full_path, tmp_path)
+                else:
+                    # mkstemp создает файл с правами 0600, новому файлу даем обычные права
+                    umask = os.umask (0)
+                    os.umask (umask)
+                    os.chmod (tmp_path, 0o666 & ~umask)
+                os.replace (tmp_path, full_path)
+            except Exception:
+                if os.path.exists (tmp_path):
+                    os.remove (tmp_path)
+                raise
 
             print (f'файл {path} обновлен')
 
             # Обновляем состояние файла
-            if clean_path in self.app_state.file_paths:
+            if clean_path in self._path_set:
                 # Если файл уже был в списке, обновляем его состояние
-                mtime = os.stat (full_path).st_mtime
-                file_state = next ((f for f in self.app_state.proj_state.files if f.path == clean_path), None)
+                file_state = self._file_index.get (clean_path)
                 if file_state:
                     file_state.mtime = int (mtime)
                     file_state.desc = ''  # Сбрасываем описание
                     file_state.desc2 = ''  # Сбрасываем краткое описание
                     file_state.embed = []  # Сбрасываем эмбеддинг
+                    invalidate_embed_matrix (self.app_state.proj_state)
                     file_state.structure = None  # Сбрасываем структуру
             else:
                 # Если это новый файл, добавляем его в список
                 self.app_state.file_paths.append (clean_path)
+                self._path_set.add (clean_path)
 
             return {
                 'path': path,
@@ -595,13 +554,10 @@ class PromptTools:
         Returns:
             str: Обработанный ответ с результатами функций
         """
-        # Шаблон для поиска вызовов функций с более точным захватом аргументов
-        function_pattern = r'\[FUNCTION: (\w+)\((.*?)\)\]'
-
         # Пока в ответе есть вызовы функций, обрабатываем их
-        while re.search(function_pattern, response):
+        while True:
             # Находим первый вызов функции
-            match = re.search(function_pattern, response)
+            match = _FUNCTION_RE.search (response)
             if not match:
                 break
 
@@ -7,16 +7,33 @@
 import os
 import re
 import json
+import base64
+import codecs
+import hashlib
 import logging
+import sqlite3
+import threading
 import pathspec
-import chardet
-from typing import List, Dict, Optional, Any, Tuple, Set, Union
 from wcmatch import glob
-import tiktoken
+from bisect import bisect_right
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Any, Tuple, Set, Union, Callable, Iterator
 from config import DATA_ROOT, LARGE_SOURCE_FILE
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+
+# Файлы BPE для tiktoken храним в папке данных, чтобы не скачивать их при каждом запуске.
+# Путь фиксируем абсолютным: tiktoken читает переменную при первой загрузке кодировщика
+os.environ.setdefault ('TIKTOKEN_CACHE_DIR', os.path.abspath (os.path.join (DATA_ROOT, '.tiktoken_cache')))
+
+# Состояние проекта читаем и пишем через orjson, если он установлен
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Тяжелые зависимости (tiktoken, sentence_transformers, детектор кодировки)
+# импортируются при первом использовании, чтобы не замедлять запуск
 
 # Будем импортировать модели только если они нам нужны
 # Это помогает избежать циклических импортов
@@ -25,6 +42,64 @@ _ProjStat = None
 _FileState = None
 _ProjState = None
 
+# Кэш количества токенов по хэшу содержимого: неизмененные файлы
+# и повторяющиеся сообщения чата не токенизируются повторно
+_tokens_cnt_cache: Dict[bytes, int] = {}
+
+# Единицы измерения размера и пороги перехода к следующей единице
+_SIZE_UNITS = ('', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
+_SIZE_THRESHOLDS = tuple (1000.0 ** power for power in range (1, len (_SIZE_UNITS)))
+
+# Расширения файлов, известные как текстовые и как двоичные
+_TEXT_EXTS = frozenset ({
+    'py', 'js', 'jsx', 'ts', 'tsx', 'html', 'css', 'md', 'txt', 'json', 'yaml', 'yml',
+    'c', 'cpp', 'h', 'hpp', 'java', 'cs', 'go', 'rs', 'php', 'rb', 'sh', 'bash', 'bat',
+    'xml', 'conf', 'ini', 'sql', 'csv', 'toml'
+})
+_BIN_EXTS = frozenset ({
+    'exe', 'dll', 'so', 'dylib', 'bin', 'obj', 'o', 'a', 'lib', 'pyd', 'pyc',
+    'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tif', 'tiff', 'ico', 'pdf', 'doc', 'docx',
+    'xls', 'xlsx', 'ppt', 'pptx', 'zip', 'tar', 'gz', 'rar', '7z', 'db', 'sqlite',
+    'webp', 'avif', 'heic', 'psd', 'ai', 'eps', 'svg', 'icns', 'blend', 'fbx', 'glb',
+    'woff', 'woff2', 'ttf', 'otf', 'eot',
+    'mp3', 'mp4', 'm4a', 'wav', 'flac', 'ogg', 'webm', 'avi', 'mov', 'mkv',
+    'bz2', 'xz', 'zst', 'tgz', 'whl', 'egg', 'jar', 'war', 'apk', 'dmg', 'iso', 'img', 'deb', 'rpm',
+    'class', 'wasm', 'pyo', 'elc', 'beam', 'sqlite3', 'mdb', 'pkl', 'pickle', 'npy', 'npz',
+    'parquet', 'pt', 'pth', 'onnx', 'h5', 'safetensors', 'odt', 'ods', 'odp'
+})
+
+# Языки с комментариями в стиле C (// и /* */)
+_C_LIKE_EXTS = frozenset ({
+    'js', 'jsx', 'mjs', 'cjs', 'es', 'es6', 'ts', 'tsx', 'mts', 'java', 'c', 'h', 'cpp', 'cs'
+})
+
+# Регулярные выражения для удаления комментариев компилируются один раз
+_C_BLOCK_RE = re.compile (r'/\*[\s\S]*?\*/')
+_HTML_COMMENT_RE = re.compile (r'<!--[^>]*-->')
+# Токенизаторы одной строки: литерал в кавычках или начало комментария
+_PY_TOKEN_RE = re.compile (r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|#')
+_C_TOKEN_RE = re.compile (r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|`(?:[^`\\]|\\.)*`|//')
+# Код строки до комментария: литералы пропускаются целиком, непарная кавычка считается кодом
+_PY_CODE_RE = re.compile (
+    r'[^"\'#]*(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"|\'[^\'\\]*(?:\\.[^\'\\]*)*\'|["\'])[^"\'#]*)*'
+)
+_C_CODE_RE = re.compile (
+    r'[^"\'`/]*(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"|\'[^\'\\]*(?:\\.[^\'\\]*)*\'|`[^`\\]*(?:\\.[^`\\]*)*`'
+    r'|/(?!/)|["\'`])[^"\'`/]*)*'
+)
+# Многострочные конструкции: (поиск открывающего разделителя, закрывающий разделитель).
+# Блочные комментарии удаляются, многострочные литералы сохраняются как есть
+_PY_SPANS = ((re.compile ('"""'), '"""'), (re.compile ("'''"), "'''"))
+_C_SPANS = ((re.compile (r'/\*'), '*/'), (re.compile ('`'), '`'))
+# Символы-заменители литералов на время построчной обработки
+_PLACEHOLDERS = ('\x00', '\x01', '\x02', '\x03')
+# Длина строки, начиная с которой литералы в ней не разбираются
+_LONG_LINE = 10000
+
+
+# Имена файлов, которые обычно стоит исключать из проекта
+_KNOWN_EXCLUDE_FILES = frozenset ({"yarn.lock", "package-lock.json", ".DS_Store", "Thumbs.db"})
+
 
 def auto_detect_exclude_candidates(base_path: str) -> Dict[str, List[str]]:
     """
@@ -64,15 +139,18 @@ def auto_detect_exclude_candidates(base_path: str) -> Dict[str, List[str]]:
 
         # Ищем бинарные файлы
         for file in files:
+            ext = file.split ('.')[-1] if '.' in file else ''
+            # Тип уже признан двоичным: повторно читать содержимое таких файлов незачем
+            if ext in binary_file_types and file not in _KNOWN_EXCLUDE_FILES:
+                continue
+
             if not is_text_file (os.path.join (root, file)):
-                ext = file.split ('.')[-1] if '.' in file else ''
                 if ext:
                     binary_file_types.add (ext)
 
                 # Проверяем известные бинарные файлы
-                for known_file in ["yarn.lock", "package-lock.json", ".DS_Store", "Thumbs.db"]:
-                    if file == known_file:
-                        common_binary_files.add (known_file)
+                if file in _KNOWN_EXCLUDE_FILES:
+                    common_binary_files.add (file)
 
     # Добавляем найденные директории и типы файлов
     for dir_path in large_dirs:
@@ -156,15 +234,11 @@ def is_default(input_str: str) -> bool:
 # Утилиты для форматирования вывода
 def bytes_to_str(num: int, suffix: str = 'B') -> str:
     """Преобразует количество байтов в удобочитаемую строку"""
-    k_base = 1000.0
-    for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
-        if abs (num) < k_base:
-            if unit == '':
-                return f"{num:.0f} {unit}{suffix}"
-            else:
-                return f"{num:3.1f} {unit}{suffix}"
-        num /= k_base
-    return f"{num:.1f} Y{suffix}"
+    # Индекс единицы измерения находим двоичным поиском по порогам вместо цикла делений
+    index = bisect_right (_SIZE_THRESHOLDS, abs (num))
+    if index == 0:
+        return f"{num:.0f} {suffix}"
+    return f"{num / _SIZE_THRESHOLDS[index - 1]:3.1f} {_SIZE_UNITS[index]}{suffix}"
 
 
 # Утилиты для работы с файлами
@@ -187,8 +261,17 @@ def load_gitignore(root_path: str) -> pathspec.PathSpec:
         return pathspec.PathSpec.from_lines ('gitwildmatch', [])
 
 
-def is_text_file(file_path: str) -> bool:
-    """Определяет, является ли файл текстовым или двоичным"""
+def is_text_file(file_path: str, stat: Optional[os.stat_result] = None) -> bool:
+    """
+    Определяет, является ли файл текстовым или двоичным
+
+    Args:
+        file_path: путь к файлу
+        stat: уже полученный результат stat файла, чтобы не запрашивать его повторно
+
+    Returns:
+        True, если файл текстовый
+    """
     # Проверка по расширению
     if is_text_by_ext (file_path):
         return True
@@ -196,46 +279,81 @@ def is_text_file(file_path: str) -> bool:
         return False
 
     # Проверка по содержимому
-    return is_text_by_enc (file_path)
+    return is_text_by_enc (file_path, stat)
+
+
+@lru_cache (maxsize=1)
+def _get_encoding_detector() -> Callable[[bytes], Dict[str, Any]]:
+    """Возвращает самую быструю из доступных реализаций определения кодировки"""
+    try:
+        from cchardet import detect
+    except ImportError:
+        try:
+            from charset_normalizer import detect
+        except ImportError:
+            from chardet import detect
+    return detect
 
 
 def is_text_by_ext(file_path: str) -> bool:
     """Проверяет, является ли файл текстовым по его расширению"""
-    # Список текстовых расширений
-    text_exts = [
-        'py', 'js', 'jsx', 'ts', 'tsx', 'html', 'css', 'md', 'txt', 'json', 'yaml', 'yml',
-        'c', 'cpp', 'h', 'hpp', 'java', 'cs', 'go', 'rs', 'php', 'rb', 'sh', 'bash', 'bat',
-        'xml', 'conf', 'ini', 'sql', 'csv', 'toml'
-    ]
     ext = os.path.splitext (file_path)[1][1:].lower ()
-    return ext in text_exts
+    return ext in _TEXT_EXTS
 
 
 def is_bin_by_ext(file_path: str) -> bool:
     """Проверяет, является ли файл двоичным по его расширению"""
-    # Список двоичных расширений
-    binary_exts = [
-        'exe', 'dll', 'so', 'dylib', 'bin', 'obj', 'o', 'a', 'lib', 'pyd', 'pyc',
-        'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tif', 'tiff', 'ico', 'pdf', 'doc', 'docx',
-        'xls', 'xlsx', 'ppt', 'pptx', 'zip', 'tar', 'gz', 'rar', '7z', 'db', 'sqlite'
-    ]
     ext = os.path.splitext (file_path)[1][1:].lower ()
-    return ext in binary_exts
+    return ext in _BIN_EXTS
 
 
-def is_text_by_enc(file_path: str) -> bool:
+def is_text_by_enc(file_path: str, stat: Optional[os.stat_result] = None) -> bool:
     """Проверяет, является ли файл текстовым по его кодировке"""
+    if stat is None:
+        try:
+            stat = os.stat (file_path)
+        except OSError:
+            return False
+    # Ключ включает время изменения и размер, так что измененный файл проверяется заново
+    return _is_text_by_enc_cached (file_path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache (maxsize=8192)
+def _is_text_by_enc_cached(file_path: str, mtime_ns: int, size: int) -> bool:
+    """Определяет кодировку начала файла и проверяет, что он декодируется"""
     try:
-        with open (file_path, 'rb') as file:
-            raw_data = file.read (512)
-            encoding = chardet.detect (raw_data)['encoding']
-            try:
-                if encoding:
-                    raw_data.decode (encoding)
-                return True
-            except (UnicodeDecodeError, TypeError):
-                return False
-    except:
+        # Читаем начало файла напрямую через дескриптор, минуя буферизованный ввод-вывод
+        fd = os.open (file_path, os.O_RDONLY)
+        try:
+            raw_data = os.read (fd, 4096)
+        finally:
+            os.close (fd)
+    except OSError:
+        return False
+
+    # Нулевой байт практически всегда означает двоичный файл
+    if b'\x00' in raw_data:
+        return False
+
+    # Чистый ASCII проверяется одним проходом без декодирования
+    if raw_data.isascii ():
+        return True
+
+    # Большинство исходников в UTF-8: в этом случае детектор не нужен.
+    # Прочитанный блок может обрезать многобайтовый символ на конце,
+    # поэтому незавершенный хвост допускается
+    try:
+        codecs.getincrementaldecoder ('utf-8') ().decode (raw_data, final=False)
+        return True
+    except UnicodeDecodeError:
+        pass
+
+    encoding = _get_encoding_detector () (raw_data)['encoding']
+    try:
+        if encoding:
+            raw_data.decode (encoding)
+        return True
+    except (UnicodeDecodeError, LookupError, TypeError):
         return False
 
 
@@ -260,6 +378,15 @@ class FileFilter:
         self.excluded_file_types = set (excluded_file_types or [])
         self.excluded_file_names = set (excluded_file_names or [])
 
+        # Все исключаемые директории проверяются одним скомпилированным выражением:
+        # совпадение в начале пути или сразу после '/'
+        normalized_dirs = [excluded.replace ('\\', '/') for excluded in self.excluded_dirs]
+        self._excluded_dir_re = None
+        if normalized_dirs:
+            alternatives = '|'.join (re.escape (excluded) for excluded in normalized_dirs)
+            self._excluded_dir_re = re.compile (f'(?:^|/)(?:{alternatives})')
+        self._excluded_prefixes = tuple (self.excluded_dirs)
+
     def should_exclude_dir(self, path: str) -> bool:
         """
         Проверяет, должна ли директория быть исключена
@@ -275,13 +402,11 @@ class FileFilter:
         if not normalized_path.endswith ('/'):
             normalized_path += '/'
 
-        # Проверяем, содержится ли исключаемая директория в пути
-        for excluded in self.excluded_dirs:
-            excluded_norm = excluded.replace ('\\', '/')
-            # Проверяем как начало пути, так и наличие в середине пути
-            if normalized_path.startswith (excluded_norm) or ('/' + excluded_norm) in normalized_path:
-                return True
-        return False
+        # Проверяем, содержится ли исключаемая директория в пути:
+        # как начало пути, так и в середине пути
+        if self._excluded_dir_re is None:
+            return False
+        return self._excluded_dir_re.search (normalized_path) is not None
 
     def should_exclude_file(self, path: str) -> bool:
         """
@@ -305,11 +430,7 @@ class FileFilter:
             return True
 
         # Проверяем путь к файлу
-        for excluded in self.excluded_dirs:
-            if path.startswith (excluded) or path.replace ('\\', '/').startswith (excluded):
-                return True
-
-        return False
+        return path.startswith (self._excluded_prefixes) or path.replace ('\\', '/').startswith (self._excluded_prefixes)
 
 
 
@@ -318,60 +439,282 @@ def remove_comments(file_name: str, file_content: str) -> str:
     """Удаляет комментарии из кода в зависимости от типа файла"""
     file_extension = file_name.split ('.')[-1].lower () if '.' in file_name else ''
 
-    if file_extension in ['js', 'jsx', 'mjs', 'cjs', 'es', 'es6', 'ts', 'tsx', 'mts', 'java', 'c', 'h', 'cpp', 'cs']:
-        # Удаляем блочные комментарии
-        file_content = re.sub (r'/\*[\s\S]*?\*/', '', file_content)
-
-        # Удаляем строчные комментарии
-        lines = file_content.splitlines ()
-        lines = [line for line in lines if not line.strip ().startswith ('//')]
-        lines = [line.split ('//')[0].rstrip () for line in lines]
-        return '\n'.join (lines)
+    if file_extension in _C_LIKE_EXTS:
+        return _remove_line_comments (file_content, '//', _C_TOKEN_RE, _C_CODE_RE, _C_SPANS)
 
     elif file_extension == 'css':
-        return re.sub (r'/\*[\s\S]*?\*/', '', file_content)
+        return _C_BLOCK_RE.sub ('', file_content)
 
     elif file_extension == 'html':
-        return re.sub (r'<!--[^>]*-->', '', file_content)
+        return _HTML_COMMENT_RE.sub ('', file_content)
 
     elif file_extension == 'py':
-        lines = file_content.splitlines ()
-        lines = [line for line in lines if not line.strip ().startswith ('#')]
-        lines = [line.split ('#')[0].rstrip () for line in lines]
-        return '\n'.join (lines)
+        return _remove_line_comments (file_content, '#', _PY_TOKEN_RE, _PY_CODE_RE, _PY_SPANS)
 
     else:
         return file_content
 
 
+def _remove_line_comments(text: str, marker: str, token_re: re.Pattern, code_re: re.Pattern,
+                          delimiters: Tuple) -> str:
+    """
+    Удаляет строчные (и для C-подобных языков блочные) комментарии
+
+    Регулярные выражения запускаются только там, где в строке есть кавычки, остальные
+    строки обрабатываются методами str. Как и при построчной обработке со склейкой
+    строк через '\\n', завершающий перевод строки не сохраняется.
+
+    Args:
+        text: Исходный текст
+        marker: Начало строчного комментария ('#' или '//')
+        token_re: Токенизатор строки для проверки разделителей
+        code_re: Выражение, совпадающее с кодом строки до комментария
+        delimiters: Многострочные конструкции языка
+
+    Returns:
+        Текст без комментариев и пробелов в конце строк
+    """
+    if marker not in text and '/*' not in text:
+        if text.endswith ('\n'):
+            text = text[:-1]
+        return '\n'.join ([line.rstrip () for line in text.split ('\n')])
+
+    placeholder = next ((char for char in _PLACEHOLDERS if char not in text), None)
+    text, literals = _extract_spans (text, marker, token_re, delimiters, placeholder)
+    if text.endswith ('\n'):
+        text = text[:-1]
+
+    lines = []
+    for line in text.split ('\n'):
+        if marker not in line:
+            lines.append (line.rstrip ())
+        elif line.lstrip ().startswith (marker):
+            # Строка целиком из комментария удаляется
+            continue
+        elif '"' not in line and "'" not in line and '`' not in line:
+            lines.append (line.partition (marker)[0].rstrip ())
+        else:
+            lines.append (_cut_line_comment (line, code_re))
+    text = '\n'.join (lines)
+
+    if literals:
+        pieces = text.split (placeholder)
+        literals.append ('')
+        text = ''.join ([part for pair in zip (pieces, literals) for part in pair])
+    return text
+
+
+def _cut_line_comment(line: str, code_re: re.Pattern) -> str:
+    """Отрезает комментарий в конце строки с кавычками, не трогая маркер внутри литералов"""
+    # Очень длинные строки (минифицированный код) оставляем как есть: разбор
+    # литералов в них дорог, а ошибка отрезала бы большую часть файла
+    if len (line) > _LONG_LINE:
+        return line.rstrip ()
+    return line[:code_re.match (line).end ()].rstrip ()
+
+
+def _extract_spans(text: str, marker: str, token_re: re.Pattern, delimiters: Tuple,
+                   placeholder: Optional[str]) -> Tuple[str, List[str]]:
+    """
+    Удаляет блочные комментарии и заменяет многострочные литералы с маркером комментария
+
+    Литерал заменяется заменителем, только если маркер встречается внутри него или
+    в остатке его последней строки, иначе построчная обработка его не испортит.
+    Состояние разбора текущей строки переносится от разделителя к разделителю,
+    поэтому каждый символ токенизируется не более одного раза. В очень длинных
+    строках многострочные конструкции не ищутся, их обрабатывает построчный проход.
+
+    Args:
+        text: Исходный текст
+        marker: Начало строчного комментария
+        token_re: Токенизатор строки
+        delimiters: Пары (поиск открывающего разделителя, закрывающий разделитель)
+        placeholder: Заменитель литералов, None - литералы не заменяются
+
+    Returns:
+        Текст после замен и список вырезанных литералов по порядку
+    """
+    parts = []
+    literals = []
+    pos = 0
+    # Начало и конец (-1 - еще не найден) текущей строки; до code_until
+    # включительно в ней точно код, а разбор продолжается с code_from
+    line_start = code_from = code_until = 0
+    line_end = -1
+    (search_a, closer_a), (search_b, closer_b) = [(regex.search, closer) for regex, closer in delimiters]
+    match_a = search_a (text)
+    match_b = search_b (text)
+    while match_a or match_b:
+        if match_b is None or match_a and match_a.start () < match_b.start ():
+            match, closer = match_a, closer_a
+        else:
+            match, closer = match_b, closer_b
+        start, end = match.span ()
+
+        newline = text.rfind ('\n', code_from, start)
+        if newline >= 0:
+            line_start = code_from = code_until = newline + 1
+            line_end = -1
+
+        # Разделитель внутри литерала, комментария или очень длинной строки пропускается
+        skip = 0
+        if start > code_until:
+            prefix = text[code_from:start]
+            if ('"' not in prefix and "'" not in prefix and '`' not in prefix
+                    and text.find (marker, code_from, start + len (marker) - 1) < 0):
+                code_from = code_until = start
+            else:
+                if line_end < 0:
+                    line_end = text.find ('\n', start)
+                    if line_end < 0:
+                        line_end = len (text)
+                if line_end - line_start > _LONG_LINE:
+                    skip = line_end
+                else:
+                    code_until = line_end
+                    for token in token_re.finditer (text, code_from, line_end):
+                        if token.start () >= start:
+                            code_until = token.start ()
+                        elif token.group ()[0] not in '"\'`':
+                            skip = line_end
+                        elif token.end () > start:
+                            skip = token.end ()
+                        else:
+                            continue
+                        break
+                code_from = code_until = skip or code_until
+        if skip:
+            if match_a and match_a.start () < skip:
+                match_a = search_a (text, skip)
+            if match_b and match_b.start () < skip:
+                match_b = search_b (text, skip)
+            continue
+
+        end = text.find (closer, end)
+        if end > 0 and closer != '*/' and text[end - 1] == '\\':
+            end = _find_closer (text, closer, end)
+        # Конструкция не закрыта: дальше по тексту таких закрытий тоже нет
+        if end < 0:
+            if match is match_a:
+                match_a = None
+            else:
+                match_b = None
+            continue
+
+        end += len (closer)
+        if closer == '*/':
+            parts.append (text[pos:start])
+            pos = end
+        elif placeholder is not None:
+            line_end = text.find ('\n', end)
+            if text.find (marker, start, len (text) if line_end < 0 else line_end) >= 0:
+                parts.append (text[pos:start])
+                parts.append (placeholder)
+                literals.append (text[start:end])
+                pos = end
+        # Конструкция могла занять несколько строк: текущая строка начинается не раньше end
+        line_start = code_from = code_until = end
+        line_end = -1
+        if match_a and match_a.start () < end:
+            match_a = search_a (text, end)
+        if match_b and match_b.start () < end:
+            match_b = search_b (text, end)
+
+    if not parts:
+        return text, literals
+    parts.append (text[pos:])
+    return ''.join (parts), literals
+
+
+def _find_closer(text: str, closer: str, index: int) -> int:
+    """Пропускает экранированные обратной косой чертой закрывающие разделители"""
+    while index >= 0:
+        backslashes = 0
+        while text[index - backslashes - 1] == '\\':
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+        index = text.find (closer, index + 1)
+    return index
+
+
 def trim_code(text: str) -> str:
     """Удаляет лишние пустые строки из кода"""
-    lines = text.splitlines ()
     result = []
-
-    # Заменяем более 1 пустой строки просто на 1 пустую строку
-    for line in lines:
-        if line.strip () == '' and (not result or result[-1].strip () == ''):
+    # Пустые строки в начале файла отбрасываются так же, как повторные
+    prev_empty = True
+    last_non_empty = 0
+
+    # Заменяем более 1 пустой строки просто на 1 пустую строку, за один проход
+    for line in text.splitlines ():
+        is_empty = not line.strip ()
+        if is_empty and prev_empty:
             continue
         result.append (line)
+        if not is_empty:
+            last_non_empty = len (result)
+        prev_empty = is_empty
 
-    # Удаляем пустые строки в конце файла
-    while result and result[-1].strip () == '':
-        result.pop ()
-
+    # Пустые строки в конце файла отсекаем по индексу последней непустой
+    del result[last_non_empty:]
     return '\n'.join (result)
 
 
 # Утилиты для токенизации и оценки стоимости
+@lru_cache (maxsize=4)
+def _get_encoder(model: str = 'gpt-3.5-turbo'):
+    """Возвращает кодировщик tiktoken, создавая его один раз на процесс"""
+    import tiktoken
+    return tiktoken.encoding_for_model (model)
+
+
+def _tokens_cnt_key(text: str) -> bytes:
+    """Возвращает ключ кэша количества токенов для текста"""
+    return hashlib.blake2b (text.encode ('utf-8', errors='surrogatepass'), digest_size=16).digest ()
+
+
 def get_tokens_cnt(text: str) -> int:
     """Подсчитывает количество токенов в тексте"""
-    encoder = tiktoken.encoding_for_model ('gpt-3.5-turbo')
-    return len (encoder.encode (text, disallowed_special=()))
+    key = _tokens_cnt_key (text)
+    tokens_cnt = _tokens_cnt_cache.get (key)
+    if tokens_cnt is None:
+        encoder = _get_encoder ()
+        tokens_cnt = len (encoder.encode (text, disallowed_special=()))
+        _tokens_cnt_cache[key] = tokens_cnt
+    return tokens_cnt
+
+
+def get_tokens_cnt_batch(texts: List[str]) -> List[int]:
+    """
+    Подсчитывает количество токенов для списка текстов
+
+    Тексты, которых нет в кэше, кодируются одним пакетом: tiktoken
+    обрабатывает пакет в нескольких потоках без GIL.
+
+    Args:
+        texts: список текстов
+
+    Returns:
+        List[int]: количество токенов для каждого текста
+    """
+    keys = [_tokens_cnt_key (text) for text in texts]
+    missing = {}
+    for key, text in zip (keys, texts):
+        if key not in _tokens_cnt_cache:
+            missing.setdefault (key, text)
+
+    if missing:
+        # encode_ordinary не выделяет специальные токены, как и encode с disallowed_special=()
+        encoded = _get_encoder ().encode_ordinary_batch (list (missing.values ()))
+        for key, tokens in zip (missing, encoded):
+            _tokens_cnt_cache[key] = len (tokens)
+
+    return [_tokens_cnt_cache[key] for key in keys]
 
 
 def limit_string(text: str, max_tokens: int) -> str:
     """Ограничивает длину строки до указанного количества токенов"""
-    encoder = tiktoken.encoding_for_model ('gpt-3.5-turbo')
+    encoder = _get_encoder ()
     tokens = encoder.encode (text, disallowed_special=())
     if len (tokens) > max_tokens:
         return encoder.decode (tokens[:max_tokens])
@@ -431,6 +774,12 @@ model_pricing = [
     },
 ]
 
+@lru_cache (maxsize=64)
+def _get_pricing(model: str) -> Optional[Dict[str, Any]]:
+    """Находит цены для модели по суффиксу идентификатора; результат поиска кэшируется"""
+    return next ((p for p in model_pricing if model.endswith (p['model'])), None)
+
+
 def get_cost(model: str, in_tokens: int, out_tokens: int, image_size_kb: int = 0) -> float:
     """
     Рассчитывает стоимость запроса на основе модели, количества токенов и размера изображений
@@ -444,7 +793,7 @@ def get_cost(model: str, in_tokens: int, out_tokens: int, image_size_kb: int = 0
     Returns:
         Общая стоимость запроса в долларах США
     """
-    pricing = next ((p for p in model_pricing if model.endswith (p['model'])), None)
+    pricing = _get_pricing (model)
     if not pricing:
         return 0.0
 
@@ -495,22 +844,28 @@ def list_project_files(folder_path: str, include: List[str], exclude: List[str],
         excluded_file_names=excluded_file_names
     )
 
+    # Шаблоны включения и исключения компилируются один раз на весь обход.
+    # Это glob с ** (а не правила .gitignore): * не захватывает точку в начале
+    # имени и не переходит в подпапки. Исключения проверяются отдельно от .gitignore
+    include_spec = glob.compile (include, flags=glob.GLOBSTAR)
+    exclude_spec = glob.compile (exclude, flags=glob.GLOBSTAR)
+
     files = build_file_tree (
         folder_path,
         folder_path,
         gitignore,
-        include,
-        exclude,
+        include_spec,
+        exclude_spec,
         file_filter
     ).folder_content
 
-    files = remove_empty_folders (files)
-    files = sort_file_data_alphabetically (files)
+    files = prune_and_sort_tree (files)
     return files
 
 
 def build_file_tree(root_directory: str, directory: str, gitignore_spec: pathspec.PathSpec,
-                    include_patterns: List[str], exclude_patterns: List[str], file_filter: FileFilter = None):
+                    include_spec: Any, exclude_spec: Any,
+                    file_filter: FileFilter = None, open_dirs: Set[Tuple[int, int]] = None):
     """
     Строит дерево файлов проекта с учетом фильтров
 
@@ -518,115 +873,192 @@ def build_file_tree(root_directory: str, directory: str, gitignore_spec: pathspe
         root_directory: корневая директория проекта
         directory: текущая директория
         gitignore_spec: спецификация .gitignore
-        include_patterns: шаблоны включения
-        exclude_patterns: шаблоны исключения
+        include_spec: скомпилированные шаблоны включения
+        exclude_spec: скомпилированные шаблоны исключения
         file_filter: фильтр файлов
+        open_dirs: (st_dev, st_ino) папок на текущем пути обхода
 
     Returns:
         Узел дерева файлов
     """
     _lazy_import_models ()
-    entries = os.listdir (directory)
     folder_content = []
 
     # Создаем фильтр файлов, если он не передан
     if file_filter is None:
         file_filter = FileFilter ()
 
-    for entry in entries:
-        full_path = os.path.join (directory, entry)
-        relative_path = os.path.relpath (full_path, start=root_directory)
+    if open_dirs is None:
+        root_stat = os.stat (directory)
+        open_dirs = {(root_stat.st_dev, root_stat.st_ino)}
+
+    # Относительный путь получаем срезом вместо os.path.relpath для каждого элемента
+    root_len = len (os.path.join (root_directory, ''))
+
+    # os.scandir возвращает тип элемента вместе с именем, без отдельного stat на каждый файл
+    with os.scandir (directory) as entries:
+        for entry in entries:
+            relative_path = entry.path[root_len:]
+
+            # Символические ссылки на папки обходятся так же, как обычные папки
+            if entry.is_dir ():
+                # Путь папки проверяем с завершающим слешем: так срабатывают шаблоны
+                # вида node_modules/, и исключенное поддерево не обходится целиком
+                if gitignore_spec.match_file (relative_path + '/'):
+                    continue
+
+                # Проверяем исключение директории
+                if file_filter.should_exclude_dir (relative_path):
+                    continue
+
+                # Папка, уже открытая выше по пути обхода, пропускается:
+                # ссылка на родительскую папку иначе зациклила бы рекурсию
+                try:
+                    dir_stat = entry.stat ()
+                except OSError:
+                    continue
+                dir_key = (dir_stat.st_dev, dir_stat.st_ino)
+                if dir_key in open_dirs:
+                    continue
+
+                open_dirs.add (dir_key)
+                try:
+                    folder_node = build_file_tree (
+                        root_directory,
+                        entry.path,
+                        gitignore_spec,
+                        include_spec,
+                        exclude_spec,
+                        file_filter,
+                        open_dirs
+                    )
+                finally:
+                    open_dirs.discard (dir_key)
+                folder_content.append (folder_node)
+            else:
+                # Проверяем правила .gitignore и шаблоны исключения
+                if gitignore_spec.match_file (relative_path) or exclude_spec.match (relative_path):
+                    continue
 
-        # Проверяем правила .gitignore
-        if gitignore_spec.match_file (relative_path):
-            continue
+                # Проверяем файл по всем фильтрам
+                if file_filter.should_exclude_file (relative_path):
+                    continue
 
-        # Проверяем исключение директории
-        if os.path.isdir (full_path):
-            # Проверяем исключение директории
-            if file_filter.should_exclude_dir (relative_path):
-                continue
+                if not include_spec.match (relative_path):
+                    continue
 
-            folder_node = build_file_tree (
-                root_directory,
-                full_path,
-                gitignore_spec,
-                include_patterns,
-                exclude_patterns,
-                file_filter
-            )
-            folder_content.append (folder_node)
-        else:
-            # Проверяем файл по всем фильтрам
-            if file_filter.should_exclude_file (relative_path):
-                continue
+                # Один stat на файл: он нужен и для проверки содержимого, и для размера,
+                # который compute_sizes затем не запрашивает повторно
+                try:
+                    stat = entry.stat ()
+                except OSError:
+                    stat = None
 
-            match_include = any (glob_match (relative_path, pattern) for pattern in include_patterns)
-            match_exclude = any (glob_match (relative_path, pattern) for pattern in exclude_patterns)
-            if not match_include or match_exclude:
-                continue
+                if not is_text_file (entry.path, stat):
+                    continue
 
-            if not is_text_file (full_path):
-                continue
-
-            file_node = _FileNode (entry, False, [], 0, 0)
-            folder_content.append (file_node)
+                file_node = _FileNode (entry.name, False, [], stat.st_size if stat else 0, 0)
+                folder_content.append (file_node)
 
     return _FileNode (os.path.basename (directory), True, folder_content, 0, 0)
 
 
-def glob_match(name: str, pat: str) -> bool:
-    """Проверяет, соответствует ли имя файла шаблону glob"""
-    return glob.globmatch (name, pat, flags=glob.GLOBSTAR)
+def prune_and_sort_tree(files: List) -> List:
+    """
+    Удаляет пустые папки и сортирует дерево по алфавиту с приоритетом для папок
 
+    Обе операции выполняются за один нерекурсивный обход: папки обрабатываются
+    снизу вверх, поэтому к моменту обработки папки ее вложенные папки уже
+    очищены и отсортированы.
+    """
+    # Обратный прямой порядок обхода ставит вложенные папки раньше родительских
+    folders = []
+    stack = [node for node in files if node.is_folder]
+    while stack:
+        folder = stack.pop ()
+        folders.append (folder)
+        stack.extend (node for node in folder.folder_content if node.is_folder)
 
-def remove_empty_folders(file_data_array: List) -> List:
-    """Удаляет пустые папки из дерева файлов"""
+    for folder in reversed (folders):
+        folder.folder_content = _prune_and_sort_level (folder.folder_content)
 
-    def is_not_empty_folder(file_node) -> bool:
-        if file_node.is_folder:
-            file_node.folder_content = remove_empty_folders (file_node.folder_content)
-            return len (file_node.folder_content) > 0
-        return True
+    return _prune_and_sort_level (files)
 
-    return list (filter (is_not_empty_folder, file_data_array))
 
+def _prune_and_sort_level(nodes: List) -> List:
+    """Отбрасывает пустые папки одного уровня и сортирует его, папки первыми"""
+    nodes = [node for node in nodes if not node.is_folder or node.folder_content]
+    nodes.sort (key=lambda x: (not x.is_folder, x.name))
+    return nodes
 
-def sort_file_data_alphabetically(files_data: List) -> List:
-    """Сортирует файлы по алфавиту с приоритетом для папок"""
-    # Сначала сортируем текущий уровень по алфавиту, папки первыми
-    files_data.sort (key=lambda x: (not x.is_folder, x.name))
 
-    # Затем рекурсивно сортируем содержимое каждой папки
-    for file_data in files_data:
-        if file_data.is_folder:
-            file_data.folder_content = sort_file_data_alphabetically (file_data.folder_content)
+def compute_sizes(base_path: str, files: List, remove_comments: bool, current_path: str = '') -> int:
+    """Вычисляет размеры файлов и количество токенов"""
+    file_nodes = []
+    _collect_file_nodes (files, os.path.join (base_path, current_path), file_nodes)
 
-    return files_data
+    if not remove_comments:
+        for full_path, file in file_nodes:
+            _set_file_size (file, full_path)
+    else:
+        # Чтение файлов упирается в ввод-вывод, поэтому читаем их параллельно
+        max_workers = min (32, (os.cpu_count () or 1) * 4)
+        with ThreadPoolExecutor (max_workers=max_workers) as executor:
+            contents = list (executor.map (_read_without_comments, file_nodes))
 
+        # Токены считаем одним пакетом для всех прочитанных файлов
+        loaded = [(file, content) for (_, file), content in zip (file_nodes, contents) if content is not None]
+        tokens_cnts = get_tokens_cnt_batch ([content for _, content in loaded])
+        for (file, content), tokens_cnt in zip (loaded, tokens_cnts):
+            file.size = len (content)
+            file.tokens = tokens_cnt
 
-def compute_sizes(base_path: str, files: List, remove_comments: bool, current_path: str = '') -> int:
-    """Вычисляет размеры файлов и количество токенов"""
-    total_size = 0
+    return _sum_folder_sizes (files)
+
+
+def _collect_file_nodes(files: List, folder_path: str, file_nodes: List) -> None:
+    """Собирает пары (полный путь, узел) для всех файлов дерева"""
     for file in files:
-        full_path = os.path.join (base_path, current_path, file.name)
+        full_path = os.path.join (folder_path, file.name)
         if file.is_folder:
-            file.size = compute_sizes (base_path, file.folder_content, remove_comments, os.path.join (current_path, file.name))
+            _collect_file_nodes (file.folder_content, full_path, file_nodes)
         else:
-            try:
-                if not remove_comments:
-                    file.size = os.path.getsize (full_path)
-                    file.tokens = int (file.size / 4.1)  # Приблизительный подсчет токенов
-                else:
-                    with open (full_path, 'r', encoding='utf-8') as f:
-                        content = f.read ()
-                    content = remove_comments (file.name, content)
-                    file.size = len (content)
-                    file.tokens = get_tokens_cnt (content)
-            except Exception as e:
-                print (f"Ошибка при обработке файла {full_path}: {e}")
-                file.size = 0
-                file.tokens = 0
+            file_nodes.append ((full_path, file))
+
+
+def _set_file_size(file, full_path: str) -> None:
+    """Заполняет размер файла и приблизительное количество токенов в узле дерева"""
+    try:
+        # Размер обычно уже известен после обхода дерева
+        if not file.size:
+            file.size = os.path.getsize (full_path)
+        file.tokens = int (file.size / 4.1)  # Приблизительный подсчет токенов
+    except Exception as e:
+        print (f"Ошибка при обработке файла {full_path}: {e}")
+        file.size = 0
+        file.tokens = 0
+
+
+def _read_without_comments(file_node: Tuple[str, Any]) -> Optional[str]:
+    """Читает файл и удаляет комментарии; при ошибке обнуляет размер узла и возвращает None"""
+    full_path, file = file_node
+    try:
+        with open (full_path, 'r', encoding='utf-8') as f:
+            content = f.read ()
+        return remove_comments (file.name, content)
+    except Exception as e:
+        print (f"Ошибка при обработке файла {full_path}: {e}")
+        file.size = 0
+        file.tokens = 0
+        return None
+
+
+def _sum_folder_sizes(files: List) -> int:
+    """Подсчитывает размеры папок как сумму размеров их содержимого"""
+    total_size = 0
+    for file in files:
+        if file.is_folder:
+            file.size = _sum_folder_sizes (file.folder_content)
         total_size += file.size
     return total_size
 
@@ -641,16 +1073,33 @@ def print_file_tree(files_data: List, current_path: str = '', prefix: str = '')
             print_file_tree (file.folder_content, current_path, new_prefix)
 
 
+def iter_tree_files(nodes: List, current_path: str = '') -> Iterator[Tuple[str, Any]]:
+    """
+    Обходит дерево файлов без рекурсии в прямом порядке
+
+    Args:
+        nodes: узлы верхнего уровня
+        current_path: префикс путей
+
+    Returns:
+        Итератор пар (путь к файлу, узел файла); префикс папки строится один раз
+    """
+    stack = [(iter (nodes), current_path)]
+    while stack:
+        nodes_iter, prefix = stack[-1]
+        for node in nodes_iter:
+            if node.is_folder:
+                # Спускаемся в папку, текущий уровень продолжится после нее
+                stack.append ((iter (node.folder_content), f'{prefix}{node.name}/'))
+                break
+            yield prefix + node.name, node
+        else:
+            stack.pop ()
+
+
 def get_file_paths(nodes: List, current_path: str = '') -> List[str]:
     """Извлекает плоский список путей к файлам из дерева файлов"""
-    file_paths = []
-    for node in nodes:
-        full_path = current_path + node.name
-        if node.is_folder:
-            file_paths.extend (get_file_paths (node.folder_content, full_path + '/'))
-        else:
-            file_paths.append (full_path)
-    return file_paths
+    return [path for path, _ in iter_tree_files (nodes, current_path)]
 
 
 def get_proj_stat(file_data: List) -> Any:
@@ -663,19 +1112,13 @@ def get_proj_stat(file_data: List) -> Any:
         large_files=[]
     )
 
-    def traverse_files(files, current_path: str = ''):
-        for file in files:
-            full_path = current_path + file.name
-            if file.is_folder:
-                traverse_files (file.folder_content, full_path + '/')
-            else:
-                stats.file_count += 1
-                stats.total_size += file.size
-                stats.total_tokens += file.tokens
-                if file.size > LARGE_SOURCE_FILE:
-                    stats.large_files.append ({'path': full_path, 'size': file.size})
+    for full_path, file in iter_tree_files (file_data):
+        stats.file_count += 1
+        stats.total_size += file.size
+        stats.total_tokens += file.tokens
+        if file.size > LARGE_SOURCE_FILE:
+            stats.large_files.append ({'path': full_path, 'size': file.size})
 
-    traverse_files (file_data)
     stats.large_files.sort (key=lambda x: x['size'], reverse=True)
     return stats
 
@@ -704,10 +1147,32 @@ def load_proj_state(proj_folder: str) -> Any:
         # Создать пустое состояние
         return _ProjState (remove_comments=False, files=[])
 
-    with open (path, 'r', encoding='utf-8') as file:
-        data = json.load (file)
+    with open (path, 'rb') as file:
+        raw_data = file.read ()
+    data = orjson.loads (raw_data) if orjson else json.loads (raw_data)
+
+    # Эмбеддинги хранятся квантованными; старый формат (список чисел) читается как есть.
+    # Векторы float32 сразу собираются для матрицы семантического поиска
+    vectors = []
+    for file_data in data.get ('files', []):
+        embed = file_data.get ('embed')
+        if not embed:
+            continue
+        if isinstance (embed, dict):
+            vector = _dequantize_vector (embed)
+            file_data['embed'] = vector.tolist ()
+        else:
+            vector = np.asarray (embed, dtype=np.float32)
+        vectors.append (vector)
+
+    proj_state = _ProjState.model_validate (data)
+
+    # Векторы разной размерности (смена модели) матрицу не образуют - она будет построена при поиске
+    if vectors and len ({vector.shape for vector in vectors}) == 1:
+        proj_state._embed_matrix = _normalize_rows (np.stack (vectors))
+        proj_state._embed_files = [f for f in proj_state.files if f.embed]
 
-    return _ProjState.model_validate (data)
+    return proj_state
 
 
 def save_proj_state(proj_state, proj_folder: str) -> None:
@@ -717,33 +1182,175 @@ def save_proj_state(proj_state, proj_folder: str) -> None:
     # Создаем папку, если она не существует
     os.makedirs (os.path.dirname (path), exist_ok=True)
 
-    # Форматируем JSON для более компактного хранения эмбеддингов
-    proj_state_json = json.dumps (proj_state.model_dump (), ensure_ascii=False, indent=4)
+    # Эмбеддинги сохраняем в квантованном виде: одна компактная строка вместо массива чисел
+    data = proj_state.model_dump ()
+    for file_data in data['files']:
+        if file_data['embed']:
+            file_data['embed'] = quantize_embed (file_data['embed'])
+
+    if orjson:
+        payload = orjson.dumps (data, option=orjson.OPT_INDENT_2)
+    else:
+        payload = json.dumps (data, ensure_ascii=False, indent=2).encode ('utf-8')
 
-    proj_state_json = reformat_proj_state_json (proj_state_json)
+    with open (path, 'wb') as file:
+        file.write (payload)
 
-    with open (path, 'w', encoding='utf-8') as file:
-        file.write (proj_state_json)
 
+def quantize_embed(embed: List[float]) -> Dict[str, Any]:
+    """
+    Квантует эмбеддинг в int8 с общим масштабом на вектор
 
-def reformat_proj_state_json(json_string: str) -> str:
-    """Оптимизирует JSON для более компактного хранения эмбеддингов"""
-    # Шаблон для поиска элементов массива
-    array_pattern = re.compile (r'"embed"\s*:\s*\[\s*(.*?)\s*\]', re.DOTALL)
+    Args:
+        embed: эмбеддинг в виде списка чисел
 
-    # Функция для замены найденных массивов однострочным форматом
-    def replace_array(match):
-        array_content = match.group (1)
-        # Заменяем переносы строк и лишние пробелы внутри массивов
-        single_line_array = array_content.replace ('\n', '')
-        single_line_array = re.sub (r'\s+', ' ', single_line_array)
-        return f'"embed": [{single_line_array}]'
+    Returns:
+        словарь {'scale': шаг квантования, 'q': base64 от байтов int8}
+    """
+    vector = np.asarray (embed, dtype=np.float32)
+    scale = float (np.max (np.abs (vector))) / 127 or 1.0
+    quantized = np.round (vector / scale).astype (np.int8)
+    return {'scale': scale, 'q': base64.b64encode (quantized.tobytes ()).decode ('ascii')}
 
-    # Применяем замену ко всей строке
-    return array_pattern.sub (replace_array, json_string)
+
+def dequantize_embed(data: Dict[str, Any]) -> List[float]:
+    """Восстанавливает эмбеддинг, сохраненный функцией quantize_embed"""
+    return _dequantize_vector (data).tolist ()
+
+
+def _dequantize_vector(data: Dict[str, Any]) -> np.ndarray:
+    """Восстанавливает эмбеддинг в виде вектора float32"""
+    quantized = np.frombuffer (base64.b64decode (data['q']), dtype=np.int8)
+    return quantized.astype (np.float32) * np.float32 (data['scale'])
 
 
 # Утилиты для работы с семантическим поиском
+class EmbeddingCache:
+    """
+    Дисковый кэш эмбеддингов содержимого файлов в SQLite
+
+    Ключ - хэш идентификатора модели и текста, значение - вектор float32.
+    Смена модели автоматически дает другие ключи, поэтому сброс кэша не нужен.
+    Эмбеддинги поисковых запросов сюда не пишутся (см. _get_query_embed).
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Открывает (при необходимости создает) базу кэша
+
+        Args:
+            db_path: путь к файлу базы SQLite
+        """
+        os.makedirs (os.path.dirname (db_path) or '.', exist_ok=True)
+        self._lock = threading.Lock ()
+        self._conn = sqlite3.connect (db_path, check_same_thread=False)
+        self._conn.execute ('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)')
+        self._conn.commit ()
+
+    @staticmethod
+    def make_key(model_id: str, text: str) -> str:
+        """Возвращает ключ кэша для пары (модель, текст)"""
+        data = f'{model_id}\0{text}'.encode ('utf-8', 'surrogatepass')
+        return hashlib.blake2b (data, digest_size=16).hexdigest ()
+
+    def get(self, model_id: str, text: str) -> Optional[np.ndarray]:
+        """Возвращает сохраненный эмбеддинг или None"""
+        key = self.make_key (model_id, text)
+        with self._lock:
+            row = self._conn.execute ('SELECT vec FROM embeddings WHERE key = ?', (key,)).fetchone ()
+        return np.frombuffer (row[0], dtype=np.float32) if row else None
+
+    def put(self, model_id: str, text: str, vector: np.ndarray) -> None:
+        """Сохраняет эмбеддинг в кэш"""
+        key = self.make_key (model_id, text)
+        blob = np.asarray (vector, dtype=np.float32).tobytes ()
+        with self._lock:
+            self._conn.execute ('INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)', (key, blob))
+            self._conn.commit ()
+
+    def get_or_compute(self, model_id: str, text: str, compute: Callable[[], Any]) -> np.ndarray:
+        """
+        Возвращает эмбеддинг из кэша, а при его отсутствии вычисляет и сохраняет
+
+        Args:
+            model_id: идентификатор (путь) модели
+            text: текст, для которого нужен эмбеддинг
+            compute: функция без аргументов, вычисляющая эмбеддинг
+
+        Returns:
+            Эмбеддинг в виде вектора float32
+        """
+        try:
+            vector = self.get (model_id, text)
+            if vector is not None:
+                return vector
+        except sqlite3.Error as e:
+            print (f"Ошибка чтения кэша эмбеддингов: {e}")
+
+        vector = np.asarray (compute (), dtype=np.float32)
+        try:
+            self.put (model_id, text, vector)
+        except sqlite3.Error as e:
+            print (f"Ошибка записи в кэш эмбеддингов: {e}")
+        return vector
+
+
+@lru_cache (maxsize=1)
+def get_embedding_cache() -> EmbeddingCache:
+    """Возвращает общий для процесса кэш эмбеддингов в папке данных"""
+    return EmbeddingCache (os.path.join (DATA_ROOT, 'embed_cache.sqlite'))
+
+
+@lru_cache (maxsize=2)
+def get_embed_model(model_path: str) -> Any:
+    """Загружает модель эмбеддингов один раз на процесс и переиспользует ее"""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer (model_path)
+
+
+def get_embed_matrix(proj_state) -> Tuple[np.ndarray, List]:
+    """
+    Возвращает матрицу (N, D) нормализованных эмбеддингов и соответствующие ей файлы
+
+    Матрица кэшируется в состоянии проекта и перестраивается, если изменился набор
+    объектов файлов с эмбеддингами (замена списка files не сбрасывает кэш, пока в нем
+    те же объекты). Если эмбеддинги меняются на месте, кэш нужно сбросить
+    через invalidate_embed_matrix.
+
+    Args:
+        proj_state: состояние проекта
+
+    Returns:
+        Кортеж (матрица float32 с единичными строками, список файлов)
+    """
+    embed_files = [f for f in proj_state.files if f.embed]
+    cached_files = proj_state._embed_files
+    if (proj_state._embed_matrix is None or len (embed_files) != len (cached_files)
+            or any (f is not cached for f, cached in zip (embed_files, cached_files))):
+        if embed_files:
+            embed_matrix = _normalize_rows (np.asarray ([f.embed for f in embed_files], dtype=np.float32))
+        else:
+            embed_matrix = np.zeros ((0, 0), dtype=np.float32)
+
+        proj_state._embed_matrix = embed_matrix
+        proj_state._embed_files = embed_files
+
+    return proj_state._embed_matrix, proj_state._embed_files
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Нормирует строки матрицы на месте, нулевые строки оставляет без изменений"""
+    norms = np.linalg.norm (matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def invalidate_embed_matrix(proj_state) -> None:
+    """Сбрасывает кэш матрицы эмбеддингов после изменения файлов проекта"""
+    proj_state._embed_matrix = None
+
+
 def find_files_semantic(query: str, app_state, page: int = 0, page_size: int = 10) -> List[str]:
     """
     Выполняет семантический поиск файлов по запросу
@@ -757,24 +1364,52 @@ def find_files_semantic(query: str, app_state, page: int = 0, page_size: int = 1
     Returns:
         Список путей к файлам, отсортированных по релевантности
     """
-    model = SentenceTransformer (app_state.app_config.embedding_model_path)
-    ref_embed = model.encode ([query], convert_to_tensor=False)[0]
+    embed_matrix, embed_files = get_embed_matrix (app_state.proj_state)
+    page_start = page * page_size
+    top_k = min (page_start + page_size, len (embed_files))
+    if page_start >= top_k:
+        return []
 
-    ref_embed_array = np.array (ref_embed).reshape (1, -1)
-    sim_res = []
+    ref_embed = _get_query_embed (app_state.app_config.embedding_model_path, query)
 
-    for file in app_state.proj_state.files:
-        if file.embed and len (file.embed) > 0:
-            file_embed_array = np.array (file.embed).reshape (1, -1)
-            similarity_score = cosine_similarity (ref_embed_array, file_embed_array)[0][0]
-            sim_res.append ((similarity_score, file))
+    # Косинусная близость со всеми файлами одним матрично-векторным умножением
+    sims = embed_matrix @ ref_embed
 
-    sim_res.sort (key=lambda x: x[0], reverse=True)
-    page_start = page * page_size
-    page_end = page_start + page_size
-    page_res = sim_res[page_start:page_end]
+    # Частичная сортировка: упорядочиваем только первые top_k результатов
+    top_idx = np.argpartition (-sims, top_k - 1)[:top_k]
+    top_idx = top_idx[np.argsort (-sims[top_idx], kind='stable')]
+
+    return [add_path_prefix (embed_files[i].path) for i in top_idx[page_start:top_k]]
+
+
+@lru_cache (maxsize=256)
+def _get_query_embed(model_path: str, query: str) -> np.ndarray:
+    """
+    Возвращает нормализованный эмбеддинг поискового запроса
+
+    Запросы кэшируются только в памяти: в отличие от содержимого файлов их поток
+    не ограничен, и хранить каждый запрос на диске незачем.
+
+    Args:
+        model_path: путь к модели эмбеддингов
+        query: строка запроса
 
-    return [add_path_prefix (item[1].path) for item in page_res]
+    Returns:
+        Вектор float32 единичной длины (только для чтения)
+    """
+    import torch
+
+    # Прямой проход без autograd: меньше аллокаций и быстрее на CPU
+    with torch.inference_mode ():
+        ref_embed = get_embed_model (model_path).encode ([query], convert_to_numpy=True)[0]
+
+    ref_embed = np.asarray (ref_embed, dtype=np.float32)
+    ref_norm = np.linalg.norm (ref_embed)
+    if ref_norm:
+        ref_embed = ref_embed / ref_norm
+    # Один и тот же массив возвращается повторно, поэтому защищаем его от изменения
+    ref_embed.setflags (write=False)
+    return ref_embed
 
 
 def add_path_prefix(path: str) -> str:
@@ -791,14 +1426,76 @@ def remove_path_prefix(path: str) -> str:
 
 def load_file_content(file_path: str, proj_path: str, remove_comments_flag: bool = False) -> str:
     """Загружает содержимое файла и при необходимости удаляет комментарии"""
+    return _load_file_entry (file_path, proj_path, remove_comments_flag).text
+
+
+class _FileContent:
+    """Подготовленное содержимое файла в кэше и его копия в нижнем регистре"""
+    __slots__ = ('text', '_lower')
+
+    def __init__(self, text: str):
+        self.text = text
+        self._lower = None
+
+    def lower(self) -> str:
+        """Возвращает текст в нижнем регистре, вычисляя его при первом обращении"""
+        if self._lower is None:
+            self._lower = self.text.lower ()
+        return self._lower
+
+
+def _load_file_entry(file_path: str, proj_path: str, remove_comments_flag: bool) -> _FileContent:
+    """Возвращает запись кэша содержимого файла"""
     full_path = os.path.join (proj_path, file_path)
-    with open (full_path, 'r', encoding='utf-8') as file:
-        content = file.read ()
+    stat = os.stat (full_path)
+    # Ключ включает время изменения и размер, так что измененный файл перечитывается
+    return _load_file_content_cached (full_path, file_path, stat.st_mtime_ns, stat.st_size, remove_comments_flag)
+
+
+@lru_cache (maxsize=1024)
+def _load_file_content_cached(full_path: str, file_path: str, mtime_ns: int, size: int,
+                              remove_comments_flag: bool) -> _FileContent:
+    """
+    Читает файл и возвращает подготовленное содержимое
+
+    Текст в нижнем регистре для поиска без учета регистра хранится в той же записи
+    и вытесняется из кэша вместе с ней.
+    """
+    # Чтение в байтах с одним декодированием быстрее текстового режима и mmap
+    with open (full_path, 'rb') as file:
+        content = file.read ().decode ('utf-8')
+
+    # То же преобразование переводов строк, что и при открытии в текстовом режиме
+    if '\r' in content:
+        content = content.replace ('\r\n', '\n').replace ('\r', '\n')
 
     if remove_comments_flag:
         content = remove_comments (file_path, content)
 
-    return trim_code (content)
+    return _FileContent (trim_code (content))
+
+
+def file_contains_bytes(file_path: str, proj_path: str, query: str) -> bool:
+    """
+    Проверяет вхождение строки в сырые байты файла без декодирования
+
+    Используется для быстрого отсева файлов при поиске с учетом регистра.
+
+    Args:
+        file_path: относительный путь к файлу
+        proj_path: путь к проекту
+        query: строка для поиска
+
+    Returns:
+        True, если строка встречается в файле
+    """
+    query_bytes = query.encode ('utf-8')
+    with open (os.path.join (proj_path, file_path), 'rb') as file:
+        return query_bytes in file.read ()
+
+
+# Количество файлов в одной задаче пула потоков при поиске
+_SEARCH_BATCH_SIZE = 64
 
 
 def find_in_files(query: str, is_case_sensitive: bool, app_state, page: int = 0,
@@ -817,30 +1514,30 @@ def find_in_files(query: str, is_case_sensitive: bool, app_state, page: int = 0,
     Returns:
         Список файлов с найденными совпадениями
     """
-    results = []
+    proj_path = app_state.proj_config.path
+    remove_comments_flag = app_state.proj_config.remove_comments
+    # Удаление комментариев может склеить текст, поэтому отсев по сырым байтам
+    # возможен только без него
+    precheck = is_case_sensitive and not remove_comments_flag
+
+    def search_batch(batch: List) -> List[Optional[Dict[str, Any]]]:
+        return [
+            _search_file (file.path, query, is_case_sensitive, proj_path, remove_comments_flag, precheck, max_lines)
+            for file in batch
+        ]
+
+    # Файлы обрабатываются пачками в пуле потоков, чтобы чтение с диска шло параллельно;
+    # map сохраняет исходный порядок файлов
+    files = app_state.proj_state.files
+    batches = [files[i:i + _SEARCH_BATCH_SIZE] for i in range (0, len (files), _SEARCH_BATCH_SIZE)]
+    if len (batches) > 1:
+        max_workers = min (32, (os.cpu_count () or 1) * 4, len (batches))
+        with ThreadPoolExecutor (max_workers=max_workers) as executor:
+            batch_results = list (executor.map (search_batch, batches))
+    else:
+        batch_results = [search_batch (batch) for batch in batches]
 
-    for file in app_state.proj_state.files:
-        try:
-            content = load_file_content (file.path, app_state.proj_config.path, app_state.proj_config.remove_comments)
-            lines = content.split ('\n')
-            matched_lines = []
-
-            for index, line in enumerate (lines):
-                if line_matches (line, query, is_case_sensitive):
-                    line_number = str (index + 1).ljust (6)
-                    matched_lines.append (f"{line_number}{line}")
-
-            if matched_lines:
-                if len (matched_lines) > max_lines:
-                    delta = len (matched_lines) - max_lines
-                    matched_lines = matched_lines[:max_lines] + [f"и еще {delta} совпадений..."]
-
-                results.append ({
-                    'path': file.path,
-                    'occurrences': matched_lines,
-                })
-        except Exception as e:
-            print (f"Ошибка при поиске в файле {file.path}: {e}")
+    results = [result for batch in batch_results for result in batch if result]
 
     # Возвращаем страницу результатов
     start_idx = page * page_size
@@ -848,6 +1545,31 @@ def find_in_files(query: str, is_case_sensitive: bool, app_state, page: int = 0,
     return results[start_idx:end_idx]
 
 
+def _search_file(file_path: str, query: str, is_case_sensitive: bool, proj_path: str,
+                 remove_comments_flag: bool, precheck: bool, max_lines: int) -> Optional[Dict[str, Any]]:
+    """Ищет строку в одном файле и возвращает результат для find_in_files или None"""
+    try:
+        if precheck and not file_contains_bytes (file_path, proj_path, query):
+            return None
+        entry = _load_file_entry (file_path, proj_path, remove_comments_flag)
+        lowered = None if is_case_sensitive else entry.lower ()
+        matches = find_matched_lines (entry.text, query, is_case_sensitive, lowered)
+        if not matches:
+            return None
+
+        matched_lines = [f"{str (index + 1).ljust (6)}{line}" for index, line in matches[:max_lines]]
+        if len (matches) > max_lines:
+            matched_lines.append (f"и еще {len (matches) - max_lines} совпадений...")
+
+        return {
+            'path': file_path,
+            'occurrences': matched_lines,
+        }
+    except Exception as e:
+        print (f"Ошибка при поиске в файле {file_path}: {e}")
+        return None
+
+
 def line_matches(line: str, query: str, is_case_sensitive: bool) -> bool:
     """Проверяет, содержит ли строка запрос с учетом регистра"""
     if is_case_sensitive:
@@ -856,6 +1578,56 @@ def line_matches(line: str, query: str, is_case_sensitive: bool) -> bool:
         return query.lower () in line.lower ()
 
 
+def find_matched_lines(content: str, query: str, is_case_sensitive: bool,
+                       lowered: Optional[str] = None) -> List[Tuple[int, str]]:
+    """
+    Находит строки содержимого, в которых встречается запрос
+
+    Вместо проверки каждой строки по отдельности содержимое приводится
+    к нижнему регистру один раз, а совпадения ищутся циклом str.find,
+    который перескакивает сразу к следующему вхождению.
+
+    Args:
+        content: содержимое файла
+        query: строка для поиска
+        is_case_sensitive: учитывать ли регистр
+        lowered: уже готовое содержимое в нижнем регистре (из кэша содержимого)
+
+    Returns:
+        Пары (индекс строки, строка) для каждой строки с совпадением
+    """
+    haystack = content
+    if not is_case_sensitive:
+        haystack = lowered if lowered is not None else content.lower ()
+        query = query.lower ()
+
+    # Пустой запрос, запрос с переводом строки или lower(), изменивший длину
+    # текста (редкие символы Unicode), обрабатываем построчно
+    if not query or '\n' in query or len (haystack) != len (content):
+        return [
+            (index, line) for index, line in enumerate (content.split ('\n'))
+            if line_matches (line, query, is_case_sensitive)
+        ]
+
+    matches = []
+    line_index = 0
+    counted_to = 0
+    pos = haystack.find (query)
+    while pos != -1:
+        line_start = haystack.rfind ('\n', 0, pos) + 1
+        line_end = haystack.find ('\n', pos)
+        if line_end == -1:
+            line_end = len (haystack)
+
+        line_index += haystack.count ('\n', counted_to, line_start)
+        counted_to = line_start
+        matches.append ((line_index, content[line_start:line_end]))
+
+        # Остальные вхождения в этой строке не нужны
+        pos = haystack.find (query, line_end + 1)
+    return matches
+
+
 def edit_list(prompt: str, initial_list: List[str]) -> List[str]:
     """
     Позволяет пользователю отредактировать список элементов